@@ -1,21 +1,30 @@
 # ========================================
 # Gmail Mail Merge Tool - Modern UI Edition (Encoding Fix)
 # ========================================
+# pandas, email.mime and the Gmail client are imported where first needed
+# so the landing page (no upload, not signed in) starts quickly
 import streamlit as st
-import pandas as pd
 import base64
+import io
 import time
 import re
 import json
 import random
 import os
+import string
+import functools
+import threading
 from datetime import datetime
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
+from email.generator import BytesGenerator
+from email.utils import make_msgid
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+
+try:
+    import orjson
+except ImportError:  # optional speed-up, stdlib json is the fallback
+    orjson = None
 
 # ========================================
 # Streamlit Page Setup
@@ -66,17 +75,47 @@ CLIENT_CONFIG = {
 # ========================================
 DONE_FILE = "/tmp/mailmerge_done.json"
 BATCH_SIZE_DEFAULT = 50
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# A 5xx on send/draft create may come after Gmail already stored the message,
+# so those calls are only retried when rate limited
+CREATE_RETRYABLE_STATUSES = {429}
+# Multiple of 57 bytes so every base64 line of the backup attachment is full
+BACKUP_CHUNK_SIZE = 57 * 1024
+ATTACHMENT_PLACEHOLDER = "@@MAILMERGE_ATTACHMENT@@"
 
 # ========================================
 # Recovery Logic
 # ========================================
-if os.path.exists(DONE_FILE) and not st.session_state.get("done", False):
+def json_loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def json_dumps(obj):
+    """Serialise to UTF-8 bytes."""
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode()
+
+def write_done_file(info):
+    # Write-then-rename so a crash never leaves a half-written DONE_FILE
+    tmp_path = DONE_FILE + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(json_dumps(info))
+    os.replace(tmp_path, DONE_FILE)
+
+# The worker writes DONE_FILE before this session has shown its own summary,
+# so only a session that isn't mid-run treats it as a previous run
+if (
+    os.path.exists(DONE_FILE)
+    and not st.session_state.get("sending", False)
+    and not st.session_state.get("done", False)
+):
     try:
-        with open(DONE_FILE, "r") as f:
-            done_info = json.load(f)
+        with open(DONE_FILE, "rb") as f:
+            done_info = json_loads(f.read())
         file_path = done_info.get("file")
         if file_path and os.path.exists(file_path):
-            st.success("✅ Previous mail merge completed successfully.")
+            if done_info.get("failed"):
+                st.warning(f"⚠️ Previous mail merge stopped early: {done_info['failed']}")
+            else:
+                st.success("✅ Previous mail merge completed successfully.")
             st.download_button(
                 "⬇️ Download Updated CSV",
                 data=open(file_path, "rb"),
@@ -94,76 +133,260 @@ if os.path.exists(DONE_FILE) and not st.session_state.get("done", False):
 # ========================================
 # Helpers
 # ========================================
-EMAIL_REGEX = re.compile(r"[\w\.-]+@[\w\.-]+\.\w+")
+EMAIL_REGEX = re.compile(r"(?<![\w.-])([\w.-]+@(?:[\w-]+\.)+\w+)")
+
+def extract_emails(values):
+    """First address found in each cell of a Series, NaN where there is none."""
+    return values.astype(str).str.extract(EMAIL_REGEX, expand=False)
+
+def read_csv_upload(uploaded_file):
+    """Read an uploaded CSV as utf-8, or as latin1 if it isn't valid utf-8."""
+    import pandas as pd
+
+    try:
+        return pd.read_csv(uploaded_file, encoding="utf-8")
+    except UnicodeDecodeError:
+        uploaded_file.seek(0)
+        return pd.read_csv(uploaded_file, encoding="latin1")
+
+def read_excel_upload(uploaded_file):
+    import pandas as pd
 
-def extract_email(value: str):
-    if not value:
-        return None
-    match = EMAIL_REGEX.search(str(value))
-    return match.group(0) if match else None
+    # calamine needs pandas>=2.2 and python-calamine; openpyxl is the fallback
+    try:
+        return pd.read_excel(uploaded_file, engine="calamine")
+    except (ImportError, ValueError):
+        uploaded_file.seek(0)
+        return pd.read_excel(uploaded_file)
+
+def write_csv(df, file_path):
+    # pyarrow's writer is much faster than to_csv, but it only produces the
+    # same file for all-text frames with nothing to quote. Numbers, bools,
+    # NaN and cells with commas, quotes or newlines (pyarrow refuses those
+    # with quoting off) all go through pandas, as does older pyarrow.
+    import pandas as pd
+
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+    except ImportError:
+        df.to_csv(file_path, index=False)
+        return
+    header = [str(col) for col in df.columns]
+    text_only = len(header) > 1 and all(
+        pd.api.types.infer_dtype(df[col], skipna=False) == "string" for col in df.columns
+    )
+    if not text_only or any(ch in name for name in header for ch in ',"\r\n'):
+        df.to_csv(file_path, index=False)
+        return
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        with open(file_path, "wb") as f:
+            f.write((",".join(header) + "\n").encode())
+            pa_csv.write_csv(table, f, pa_csv.WriteOptions(include_header=False, quoting_style="none"))
+    except (pa.ArrowException, TypeError):
+        df.to_csv(file_path, index=False)
+
+_FORMATTER = string.Formatter()
+
+def template_fields(template):
+    """Column names a str.format template reads, e.g. ['Name'] for 'Hi {Name.title}'."""
+    fields = []
+    try:
+        parsed = list(_FORMATTER.parse(template))
+    except ValueError:
+        return fields
+    for _, field_name, _, _ in parsed:
+        if field_name:
+            name = re.split(r"[.\[]", field_name, maxsplit=1)[0]
+            if name and name not in fields:
+                fields.append(name)
+    return fields
+
+_BOLD_RE = re.compile(r"\*\*(.*?)\*\*")
+_LINK_RE = re.compile(r"\[(.*?)\]\((https?://[^\s)]+)\)")
 
 def convert_bold(text):
     if not text:
         return ""
-    text = re.sub(r"\*\*(.*?)\*\*", r"<b>\1</b>", text)
-    text = re.sub(
-        r"\[(.*?)\]\((https?://[^\s)]+)\)",
-        r'<a href="\2" style="color:#1a73e8; text-decoration:underline;" target="_blank">\1</a>',
-        text,
-    )
-    text = text.replace("\n", "<br>").replace("  ", "&nbsp;&nbsp;")
+    # Cheap substring checks skip the passes a plain-text body doesn't need
+    if "**" in text:
+        text = _BOLD_RE.sub(r"<b>\1</b>", text)
+    if "](" in text:
+        text = _LINK_RE.sub(
+            r'<a href="\2" style="color:#1a73e8; text-decoration:underline;" target="_blank">\1</a>',
+            text,
+        )
+    if "\n" in text:
+        text = text.replace("\n", "<br>")
+    if "  " in text:
+        text = text.replace("  ", "&nbsp;&nbsp;")
     return f"""
     <html><body style="font-family: 'Google Sans', Arial, sans-serif; font-size: 14px; line-height: 1.6;">
         {text}
     </body></html>
     """
 
+def retry_with_backoff(max_attempts=5, base=1.0, cap=32.0, statuses=RETRYABLE_STATUSES):
+    """Retry Gmail calls on the given statuses, doubling the wait (or honouring Retry-After)."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            for attempt in range(max_attempts):
+                try:
+                    return fn(*args, **kwargs)
+                except HttpError as e:
+                    if e.resp.status not in statuses or attempt == max_attempts - 1:
+                        raise
+                    wait = min(cap, base * 2 ** attempt) + random.random()
+                    retry_after = e.resp.get("retry-after", "")
+                    if retry_after.isdigit():
+                        wait = max(wait, float(retry_after))
+                    time.sleep(wait)
+        return wrapper
+    return decorator
+
+@retry_with_backoff()
+def execute(request, http=None):
+    return request.execute(http=http)
+
+@retry_with_backoff(statuses=CREATE_RETRYABLE_STATUSES)
+def execute_create(request, http=None):
+    return request.execute(http=http)
+
+def execute_batch(service, requests, http=None, max_attempts=5, base=1.0, cap=32.0,
+                  statuses=RETRYABLE_STATUSES):
+    """Run {request_id: request} through Gmail's batch endpoint.
+
+    Items that fail with one of the given statuses are re-batched with the same backoff as
+    retry_with_backoff. If the batch call itself fails (transport error,
+    token refresh), only the items still pending get that exception; results
+    from earlier attempts are kept. Returns {request_id: (response, exception)}.
+    """
+    results = {}
+
+    def callback(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    pending = dict(requests)
+    for attempt in range(max_attempts):
+        try:
+            batch = service.new_batch_http_request(callback=callback)
+            for request_id, request in pending.items():
+                batch.add(request, request_id=request_id)
+            execute(batch, http)
+        except Exception as e:
+            for request_id in pending:
+                results[request_id] = (None, e)
+            break
+        pending = {
+            request_id: request for request_id, request in pending.items()
+            if isinstance(results[request_id][1], HttpError)
+            and results[request_id][1].resp.status in statuses
+        }
+        if not pending or attempt == max_attempts - 1:
+            break
+        time.sleep(min(cap, base * 2 ** attempt) + random.random())
+    return results
+
 def get_or_create_label(service, label_name="Mail Merge Sent"):
+    # Lowercased name -> id, fetched once per session rather than on every run
+    label_map = st.session_state.setdefault("label_map", None)
+    if label_map is None:
+        labels = execute(service.users().labels().list(userId="me")).get("labels", [])
+        label_map = {label["name"].lower(): label["id"] for label in labels}
+        st.session_state["label_map"] = label_map
+    label_id = label_map.get(label_name.lower())
+    if label_id:
+        return label_id
+    created_label = execute(service.users().labels().create(
+        userId="me",
+        body={"name": label_name, "labelListVisibility": "labelShow", "messageListVisibility": "show"},
+    ))
+    label_map[label_name.lower()] = created_label["id"]
+    return created_label["id"]
+
+def encode_raw(message):
+    """base64url of the serialised message, as the Gmail API's "raw" field expects."""
+    buf = io.BytesIO()
+    BytesGenerator(buf, mangle_from_=False, policy=message.policy).flatten(message)
+    return base64.urlsafe_b64encode(buf.getbuffer()).decode("ascii")
+
+def send_email_backup(service, csv_path, http=None):
+    """Mail the CSV to the signed-in user and return their address.
+
+    The message is written to disk with the attachment base64-encoded chunk
+    by chunk, then sent as a resumable media upload, so the CSV is never
+    held in memory whole.
+    """
+    from email.mime.base import MIMEBase
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from googleapiclient.http import MediaFileUpload
+
+    user_email = execute(service.users().getProfile(userId="me"), http)["emailAddress"]
+    file_name = os.path.basename(csv_path)
+    msg = MIMEMultipart()
+    msg["To"] = user_email
+    msg["From"] = user_email
+    msg["Subject"] = f"📁 Mail Merge Backup CSV - {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+    msg.attach(MIMEText("Attached is the backup CSV for your mail merge run.", "plain"))
+    part = MIMEBase("application", "octet-stream", Name=file_name)
+    part["Content-Transfer-Encoding"] = "base64"
+    part["Content-Disposition"] = f'attachment; filename="{file_name}"'
+    part.set_payload(ATTACHMENT_PLACEHOLDER)
+    msg.attach(part)
+    head, tail = msg.as_bytes().split(ATTACHMENT_PLACEHOLDER.encode())
+
+    eml_path = csv_path + ".eml"
     try:
-        labels = service.users().labels().list(userId="me").execute().get("labels", [])
-        for label in labels:
-            if label["name"].lower() == label_name.lower():
-                return label["id"]
-        created_label = service.users().labels().create(
-            userId="me",
-            body={"name": label_name, "labelListVisibility": "labelShow", "messageListVisibility": "show"},
-        ).execute()
-        return created_label["id"]
-    except Exception:
-        return None
+        with open(csv_path, "rb") as src, open(eml_path, "wb") as out:
+            out.write(head)
+            for chunk in iter(lambda: src.read(BACKUP_CHUNK_SIZE), b""):
+                out.write(base64.encodebytes(chunk))
+            out.write(tail)
+        media = MediaFileUpload(eml_path, mimetype="message/rfc822", resumable=True)
+        execute_create(service.users().messages().send(userId="me", body={}, media_body=media), http)
+    finally:
+        if os.path.exists(eml_path):
+            os.remove(eml_path)
+    return user_email
+
+class RateLimiter:
+    """Spaces calls ~interval seconds apart, start to start.
+
+    Time spent in the request itself counts towards the gap, so a slow send
+    doesn't stretch the delay the user picked.
+    """
 
-def send_email_backup(service, csv_path):
-    try:
-        user_email = service.users().getProfile(userId="me").execute()["emailAddress"]
-        msg = MIMEMultipart()
-        msg["To"] = user_email
-        msg["From"] = user_email
-        msg["Subject"] = f"📁 Mail Merge Backup CSV - {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-        msg.attach(MIMEText("Attached is the backup CSV for your mail merge run.", "plain"))
-        with open(csv_path, "rb") as f:
-            part = MIMEApplication(f.read(), Name=os.path.basename(csv_path))
-        part["Content-Disposition"] = f'attachment; filename="{os.path.basename(csv_path)}"'
-        msg.attach(part)
-        raw = base64.urlsafe_b64encode(msg.as_bytes()).decode()
-        service.users().messages().send(userId="me", body={"raw": raw}).execute()
-        st.info(f"📧 Backup CSV emailed to {user_email}")
-    except Exception as e:
-        st.warning(f"⚠️ Could not send backup email: {e}")
+    def __init__(self, interval, jitter=0.1):
+        self.interval = interval
+        self.jitter = jitter
+        self._next_slot = 0.0
 
-def fetch_message_id_header(service, message_id):
-    for _ in range(6):
-        try:
-            msg_detail = service.users().messages().get(
-                userId="me", id=message_id, format="metadata", metadataHeaders=["Message-ID"]
-            ).execute()
-            headers = msg_detail.get("payload", {}).get("headers", [])
-            for h in headers:
-                if h.get("name", "").lower() == "message-id":
-                    return h.get("value")
-        except Exception:
-            pass
-        time.sleep(random.uniform(1, 2))
-    return ""
+    def wait(self):
+        now = time.monotonic()
+        if self._next_slot > now:
+            time.sleep(self._next_slot - now)
+            now = self._next_slot
+        self._next_slot = now + random.uniform(self.interval * (1 - self.jitter), self.interval * (1 + self.jitter))
+
+def authorized_http(creds):
+    # httplib2 connections are not thread-safe, so the background worker gets
+    # its own; build_http() carries googleapiclient's default socket timeout
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.http import build_http
+
+    return AuthorizedHttp(creds, http=build_http())
+
+@st.cache_resource
+def get_service(creds_json):
+    # Keyed by the token JSON so each account gets its own client; skips
+    # rebuilding from the discovery document on every rerun
+    from googleapiclient.discovery import build
+
+    creds = Credentials.from_authorized_user_info(json_loads(creds_json), SCOPES)
+    return build("gmail", "v1", credentials=creds, cache_discovery=False)
 
 # ========================================
 # OAuth Flow
@@ -171,16 +394,13 @@ def fetch_message_id_header(service, message_id):
 if "creds" not in st.session_state:
     st.session_state["creds"] = None
 
-if st.session_state["creds"]:
-    creds = Credentials.from_authorized_user_info(json.loads(st.session_state["creds"]), SCOPES)
-else:
+if not st.session_state["creds"]:
     code = st.experimental_get_query_params().get("code", None)
     if code:
         flow = Flow.from_client_config(CLIENT_CONFIG, scopes=SCOPES)
         flow.redirect_uri = st.secrets["gmail"]["redirect_uri"]
         flow.fetch_token(code=code[0])
-        creds = flow.credentials
-        st.session_state["creds"] = creds.to_json()
+        st.session_state["creds"] = flow.credentials.to_json()
         st.rerun()
     else:
         flow = Flow.from_client_config(CLIENT_CONFIG, scopes=SCOPES)
@@ -189,8 +409,8 @@ else:
         st.markdown(f"### 🔑 Please [authorize the app]({auth_url}) to send emails using your Gmail account.")
         st.stop()
 
-creds = Credentials.from_authorized_user_info(json.loads(st.session_state["creds"]), SCOPES)
-service = build("gmail", "v1", credentials=creds)
+creds = Credentials.from_authorized_user_info(json_loads(st.session_state["creds"]), SCOPES)
+service = get_service(st.session_state["creds"])
 
 # ========================================
 # Session Setup
@@ -212,16 +432,12 @@ if not st.session_state["sending"]:
         # --- FIX: Safe CSV reading with encoding fallback ---
         if uploaded_file.name.lower().endswith("csv"):
             try:
-                df = pd.read_csv(uploaded_file, encoding="utf-8")
-            except UnicodeDecodeError:
-                try:
-                    uploaded_file.seek(0)
-                    df = pd.read_csv(uploaded_file, encoding="latin1")
-                except Exception:
-                    st.error("⚠️ Unable to read the uploaded CSV. Please check that it's a valid CSV file.")
-                    st.stop()
+                df = read_csv_upload(uploaded_file)
+            except Exception:
+                st.error("⚠️ Unable to read the uploaded CSV. Please check that it's a valid CSV file.")
+                st.stop()
         else:
-            df = pd.read_excel(uploaded_file)
+            df = read_excel_upload(uploaded_file)
         # -----------------------------------------------------
 
         for col in ["ThreadId", "RfcMessageId", "Status"]:
@@ -273,7 +489,8 @@ Thanks,
             # --------- FIX: Exclude both Sent and Draft rows from pending list ---------
             # Previously pending_indices = df.index[df["Status"] != "Sent"].tolist()
             # That caused 'Draft' rows to be reprocessed on subsequent runs.
-            pending_indices = df.index[~df["Status"].isin(["Sent", "Draft"])].tolist()
+            # Kept as an int64 ndarray of positions for direct numpy indexing.
+            pending_indices = (~df["Status"].isin(["Sent", "Draft"])).to_numpy().nonzero()[0]
             # ------------------------------------------------------------------------
 
             st.session_state.update({
@@ -289,120 +506,262 @@ Thanks,
             st.rerun()
 
 # ========================================
-# Sending Mode with Progress
+# Sending Worker
 # ========================================
-if st.session_state["sending"]:
-    df = st.session_state["df"]
-    pending_indices = st.session_state["pending_indices"]
-    subject_template = st.session_state["subject_template"]
-    body_template = st.session_state["body_template"]
-    label_name = st.session_state["label_name"]
-    delay = st.session_state["delay"]
-    send_mode = st.session_state["send_mode"]
+def run_sending(service, creds, job, run_state):
+    """Send one mail merge run in the background.
 
-    st.subheader("📨 Sending Emails...")
-    progress = st.progress(0)
-    status_box = st.empty()
-
-    label_id = None
-    if send_mode == "🆕 New Email":
-        label_id = get_or_create_label(service, label_name)
-
-    total = len(pending_indices)
-    sent_count, skipped, errors = 0, [], []
-    batch_count = 0
+    Runs on its own thread so Streamlit reruns can't interrupt (and restart)
+    it. No st.* calls are made here; progress, notices and the final summary
+    are written to the plain run_state dict, which the page polls.
+    """
+    import pandas as pd
+    from email.message import EmailMessage
+    from email.policy import SMTP
+
+    df = job["df"]
+    pending_indices = job["pending_indices"]
+    subject_template = job["subject_template"]
+    body_template = job["body_template"]
+    label_name = job["label_name"]
+    label_id = job["label_id"]
+    delay = job["delay"]
+    send_mode = job["send_mode"]
+    notices = run_state["notices"]
+
+    sent_count, errors = 0, []
     sent_message_ids = []
 
-    for i, idx in enumerate(pending_indices):
-        if send_mode != "💾 Save as Draft" and batch_count >= BATCH_SIZE_DEFAULT:
-            break
-        row = df.loc[idx]
-
-        pct = int(((i + 1) / total) * 100)
-        progress.progress(min(max(pct, 0), 100))
-        status_box.info(f"📩 Processing {i + 1}/{total}")
+    # Results land in plain lists and are written back to df in one go
+    statuses = df["Status"].tolist()
+    thread_ids = df["ThreadId"].tolist()
+    rfc_ids = df["RfcMessageId"].tolist()
 
-        to_addr = extract_email(str(row.get("Email", "")).strip())
-        if not to_addr:
-            skipped.append(row.get("Email"))
-            df.loc[idx, "Status"] = "Skipped"
-            continue
+    def record_error(idx, to_addr, e):
+        statuses[idx] = "Error"
+        errors.append((to_addr, str(e)))
+        notices.append(("error", f"❌ Error for {to_addr}: {e}"))
 
-        try:
-            subject = subject_template.format(**row)
-            body_html = convert_bold(body_template.format(**row))
-            message = MIMEText(body_html, "html")
+    skipped = []
+    http = authorized_http(creds)
+    try:
+        # Message-IDs are generated here rather than read back from Gmail after
+        # each send, so follow-ups can reference them without an extra request
+        sender_domain = None
+        if send_mode != "💾 Save as Draft":
+            try:
+                sender_domain = execute(service.users().getProfile(userId="me"), http)["emailAddress"].rpartition("@")[2]
+            except Exception:
+                # make_msgid falls back to the local hostname, still a unique id
+                pass
+
+        email_col = df["Email"] if "Email" in df.columns else pd.Series("", index=df.index)
+        emails = email_col.to_numpy()
+        to_addrs = extract_emails(email_col).to_numpy()
+        missing = pd.isna(to_addrs[pending_indices])
+        skipped_indices = pending_indices[missing]
+        for idx in skipped_indices.tolist():
+            statuses[idx] = "Skipped"
+        skipped = emails[skipped_indices].tolist()
+
+        send_indices = pending_indices[~missing]
+        jobs = list(zip(send_indices.tolist(), to_addrs[send_indices].tolist()))
+        if send_mode != "💾 Save as Draft":
+            jobs = jobs[:BATCH_SIZE_DEFAULT]
+
+        # Only the reply headers and the columns the templates reference are
+        # pulled out, once, as plain tuples
+        fields = [
+            f for f in dict.fromkeys(template_fields(subject_template) + template_fields(body_template))
+            if f in df.columns
+        ]
+        rows = list(df[["ThreadId", "RfcMessageId"] + fields].itertuples(index=False, name=None))
+
+        limiter = RateLimiter(delay)
+
+        def build_msg_body(idx, to_addr, message_id=None):
+            reply_thread_id, reply_rfc_id, *field_values = rows[idx]
+            values = dict(zip(fields, field_values))
+            subject = subject_template.format_map(values)
+            body_html = convert_bold(body_template.format_map(values))
+            # A bare EmailMessage is enough for a single HTML part; SMTP policy
+            # serialises with standard RFC 5322 CRLF line endings
+            message = EmailMessage(policy=SMTP)
             message["To"] = to_addr
             message["Subject"] = subject
+            if message_id:
+                message["Message-ID"] = message_id
 
             msg_body = {}
             if send_mode == "↩️ Follow-up (Reply)":
-                thread_id = str(row.get("ThreadId", "")).strip()
-                rfc_id = str(row.get("RfcMessageId", "")).strip()
+                thread_id = str(reply_thread_id).strip()
+                rfc_id = str(reply_rfc_id).strip()
                 if thread_id and rfc_id:
                     message["In-Reply-To"] = rfc_id
                     message["References"] = rfc_id
-                    raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
-                    msg_body = {"raw": raw, "threadId": thread_id}
-                else:
-                    raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
-                    msg_body = {"raw": raw}
-            else:
-                raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
-                msg_body = {"raw": raw}
-
-            if send_mode == "💾 Save as Draft":
-                service.users().drafts().create(userId="me", body={"message": msg_body}).execute()
-                df.loc[idx, "Status"] = "Draft"
-            else:
-                sent_msg = service.users().messages().send(userId="me", body=msg_body).execute()
-                msg_id = sent_msg.get("id", "")
-                df.loc[idx, "ThreadId"] = sent_msg.get("threadId", "")
-                df.loc[idx, "RfcMessageId"] = fetch_message_id_header(service, msg_id) or msg_id
-                df.loc[idx, "Status"] = "Sent"
+                    msg_body["threadId"] = thread_id
+            message.set_content(body_html, subtype="html")
+            msg_body["raw"] = encode_raw(message)
+            return msg_body
+
+        def send_one(idx, to_addr):
+            """Build and send one message; returns (msg_id, thread_id, rfc_id)."""
+            rfc_id = make_msgid(domain=sender_domain)
+            msg_body = build_msg_body(idx, to_addr, rfc_id)
+            limiter.wait()
+            sent_msg = execute_create(service.users().messages().send(userId="me", body=msg_body), http)
+            return sent_msg.get("id", ""), sent_msg.get("threadId", ""), rfc_id
+
+        total = len(jobs)
+        run_state["total"] = total
+        if send_mode == "💾 Save as Draft":
+            # Drafts are never delivered, so they skip the send pacing and go
+            # through Gmail's batch endpoint BATCH_SIZE_DEFAULT at a time
+            for start in range(0, total, BATCH_SIZE_DEFAULT):
+                chunk = jobs[start:start + BATCH_SIZE_DEFAULT]
+                requests = {}
+                for idx, to_addr in chunk:
+                    try:
+                        requests[str(idx)] = service.users().drafts().create(
+                            userId="me", body={"message": build_msg_body(idx, to_addr)}
+                        )
+                    except Exception as e:
+                        record_error(idx, to_addr, e)
+                results = execute_batch(service, requests, http, statuses=CREATE_RETRYABLE_STATUSES) if requests else {}
+                for idx, to_addr in chunk:
+                    if str(idx) not in results:
+                        continue
+                    _, exc = results[str(idx)]
+                    if exc:
+                        record_error(idx, to_addr, exc)
+                    else:
+                        statuses[idx] = "Draft"
+                        sent_count += 1
+                run_state["done"] = start + len(chunk)
+        else:
+            for i, (idx, to_addr) in enumerate(jobs):
+                run_state["done"] = i + 1
+                try:
+                    msg_id, thread_id, rfc_id = send_one(idx, to_addr)
+                except Exception as e:
+                    record_error(idx, to_addr, e)
+                    continue
+                statuses[idx] = "Sent"
+                thread_ids[idx] = thread_id
+                rfc_ids[idx] = rfc_id
                 if send_mode == "🆕 New Email" and label_id:
                     sent_message_ids.append(msg_id)
+                sent_count += 1
 
-            time.sleep(random.uniform(delay * 0.9, delay * 1.1))
-            sent_count += 1
-            batch_count += 1
-        except Exception as e:
-            df.loc[idx, "Status"] = "Error"
-            errors.append((to_addr, str(e)))
-            st.error(f"❌ Error for {to_addr}: {e}")
-
-    # Label + Backup
-    if send_mode != "💾 Save as Draft":
-        if sent_message_ids and label_id:
-            try:
-                service.users().messages().batchModify(
-                    userId="me",
-                    body={"ids": sent_message_ids, "addLabelIds": [label_id]}
-                ).execute()
-            except Exception as e:
-                st.warning(f"⚠️ Labeling failed: {e}")
+        # Label
+        if send_mode != "💾 Save as Draft":
+            if sent_message_ids and label_id:
+                try:
+                    execute(service.users().messages().batchModify(
+                        userId="me",
+                        body={"ids": sent_message_ids, "addLabelIds": [label_id]}
+                    ), http)
+                except Exception as e:
+                    notices.append(("warning", f"⚠️ Labeling failed: {e}"))
+    except Exception as e:
+        # Stop here, but still save what was done: rows already sent or
+        # drafted must keep their status so a rerun doesn't repeat them
+        run_state["failed"] = str(e)
+        notices.append(("error", f"❌ Mail merge stopped: {e}"))
+    finally:
+        df["Status"] = statuses
+        df["ThreadId"] = thread_ids
+        df["RfcMessageId"] = rfc_ids
+        run_state["summary"] = {"sent": sent_count, "errors": errors, "skipped": skipped}
+        save_run_results(service, http, df, label_name, run_state)
+
+def save_run_results(service, http, df, label_name, run_state):
+    """Write the updated CSV, mail the backup and record DONE_FILE."""
+    notices = run_state["notices"]
 
     # Save updated CSV & backup email for all modes (Draft / Sent)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     safe_label = re.sub(r'[^A-Za-z0-9_-]', '_', label_name)
     file_name = f"Updated_{safe_label}_{timestamp}.csv"
     file_path = os.path.join("/tmp", file_name)
-    df.to_csv(file_path, index=False)
+    write_csv(df, file_path)
     try:
-        send_email_backup(service, file_path)
+        user_email = send_email_backup(service, file_path, http)
+        notices.append(("info", f"📧 Backup CSV emailed to {user_email}"))
     except Exception as e:
-        st.warning(f"⚠️ Backup email failed: {e}")
+        notices.append(("warning", f"⚠️ Could not send backup email: {e}"))
 
     # Write DONE_FILE so recovery UI shows (helps prevent accidental re-run)
     try:
-        with open(DONE_FILE, "w") as f:
-            json.dump({"done_time": str(datetime.now()), "file": file_path}, f)
+        write_done_file({
+            "done_time": str(datetime.now()),
+            "file": file_path,
+            "failed": run_state.get("failed"),
+        })
     except Exception:
         pass
 
+def start_sending_thread(service, creds, job, run_state):
+    def target():
+        try:
+            run_sending(service, creds, job, run_state)
+        except Exception as e:
+            # run_sending handles send failures itself; this only catches
+            # errors from saving the results
+            run_state.setdefault("failed", str(e))
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread
+
+# ========================================
+# Sending Mode with Progress
+# ========================================
+if st.session_state["sending"]:
+    st.subheader("📨 Sending Emails...")
+
+    if st.session_state.get("send_thread") is None:
+        run_state = {"done": 0, "total": 0, "notices": []}
+
+        # The label map lives in session_state, so it's resolved here on the
+        # script thread before handing off to the worker
+        label_id = None
+        if st.session_state["send_mode"] == "🆕 New Email":
+            try:
+                label_id = get_or_create_label(service, st.session_state["label_name"])
+            except Exception as e:
+                run_state["notices"].append(
+                    ("warning", f"⚠️ Could not create label '{st.session_state['label_name']}': {e}")
+                )
+
+        job = {
+            key: st.session_state[key]
+            for key in (
+                "df", "pending_indices", "subject_template", "body_template",
+                "label_name", "delay", "send_mode",
+            )
+        }
+        job["label_id"] = label_id
+        st.session_state["run_state"] = run_state
+        st.session_state["send_thread"] = start_sending_thread(service, creds, job, run_state)
+
+    run_state = st.session_state["run_state"]
+    total = run_state["total"]
+    pct = int((run_state["done"] / total) * 100) if total else 0
+    st.progress(min(max(pct, 0), 100))
+    st.info(f"📩 Processed {run_state['done']}/{total}")
+    for kind, text in list(run_state["notices"]):
+        getattr(st, kind)(text)
+
+    if st.session_state["send_thread"].is_alive():
+        time.sleep(1)
+        st.rerun()
+
     st.session_state["sending"] = False
     st.session_state["done"] = True
-    st.session_state["summary"] = {"sent": sent_count, "errors": errors, "skipped": skipped}
+    st.session_state["summary"] = run_state.get("summary", {})
+    st.session_state["failed"] = run_state.get("failed")
+    st.session_state["send_thread"] = None
     st.rerun()
 
 # ========================================
@@ -410,8 +769,14 @@ if st.session_state["sending"]:
 # ========================================
 if st.session_state["done"]:
     summary = st.session_state.get("summary", {})
-    st.subheader("✅ Mail Merge Completed")
-    st.success(f"Sent: {summary.get('sent', 0)}")
+    failed = st.session_state.get("failed")
+    if failed:
+        st.subheader("⚠️ Mail Merge Stopped")
+        st.error(f"❌ The run stopped before finishing: {failed}")
+        st.warning(f"Processed before stopping: {summary.get('sent', 0)}")
+    else:
+        st.subheader("✅ Mail Merge Completed")
+        st.success(f"Sent: {summary.get('sent', 0)}")
     if summary.get("errors"):
         st.error(f"❌ {len(summary['errors'])} errors occurred.")
     if summary.get("skipped"):